@@ -8,7 +8,8 @@ class BaseDataLoader(DataLoader):
     """
     Base class for all data loaders
     """
-    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate):
+    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate,
+                 pin_memory=False):
         self.validation_split = validation_split
         self.shuffle = shuffle
 
@@ -22,7 +23,9 @@ class BaseDataLoader(DataLoader):
             'batch_size': batch_size,
             'shuffle': self.shuffle,
             'collate_fn': collate_fn,
-            'num_workers': num_workers
+            'num_workers': num_workers,
+            'pin_memory': pin_memory,
+            'persistent_workers': num_workers > 0
         }
         super().__init__(sampler=self.sampler, **self.init_kwargs)
 
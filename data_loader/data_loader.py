@@ -13,9 +13,9 @@ class HandWritingDataset(torch.utils.data.Dataset):
         self.sentences_path = os.path.join(data_dir, 'sentences.txt')
         self.strokes_path = os.path.join(data_dir, 'strokes-py3.npy')
 
-        self.sentences_file = open(self.sentences_path, encoding="utf8")
-
-        self.sentences = [list(preprocess_sent(sent)) for sent in self.sentences_file.readlines()]
+        # No file handle is kept open, the dataset is pickled when the data loader workers are spawned
+        with open(self.sentences_path, encoding="utf8") as sentences_file:
+            self.sentences = [list(preprocess_sent(sent)) for sent in sentences_file.readlines()]
         self.strokes = np.load(self.strokes_path, encoding='latin1', allow_pickle=True)
 
         self.all_chars = self.find_all_chars()
@@ -50,10 +50,11 @@ class HandWritingDataset(torch.utils.data.Dataset):
 
 
 class HandWritingDataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, collate_fn=pad_collate):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, collate_fn=pad_collate,
+                 pin_memory=False):
         self.data_dir = data_dir
         self.dataset = HandWritingDataset(data_dir)
-        super().__init__(self.dataset, batch_size, shuffle, validation_split, num_workers, collate_fn)
+        super().__init__(self.dataset, batch_size, shuffle, validation_split, num_workers, collate_fn, pin_memory)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,59 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def lstm_gates(gates, cx):
+    # Pointwise part of the lstm cell, same computation as nn.LSTMCell
+    ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+    cy = torch.sigmoid(forgetgate) * cx + torch.sigmoid(ingate) * torch.tanh(cellgate)
+    hy = torch.sigmoid(outgate) * torch.tanh(cy)
+    return hy, cy
+
+
+def compute_window_parameters(hidden, previous_kappa, window_weight, window_bias):
+    window_params_hat = torch.mm(hidden, window_weight.t()) + window_bias
+    alpha_hat, beta_hat, kappa_hat = window_params_hat.chunk(3, 1)
+
+    # Normalization of the params according to equations (49), (50), (51)
+    alpha = torch.exp(alpha_hat)  # (bs, K)
+    beta = torch.exp(beta_hat)
+    kappa = previous_kappa + torch.exp(kappa_hat)
+
+    return alpha, beta, kappa
+
+
+def compute_window(alpha, beta, kappa, sentences, sentences_mask, u_matrix, num_chars: int):
+    # Compute phi (bs, chars_seq_len), the params are broadcast to the target shape (bs, K, chars_seq_len)
+    distance = kappa.unsqueeze(-1) - u_matrix
+    phi = (alpha.unsqueeze(-1) * torch.exp(-beta.unsqueeze(-1) * distance * distance)).sum(1)
+
+    # Sum the masked phi of the characters into their bins, same as weighting their one hot encoding by phi
+    window = phi.new_zeros([phi.size(0), num_chars]).scatter_add(1, sentences, phi * sentences_mask)  # (bs, num_chars)
+
+    return window, phi
+
+
+def _attention_step(strokes_gates_t, hx, cx, kappa_prev, window_prev, sentences, sentences_mask, u_matrix,
+                    weight_recurrent, window_weight, window_bias, num_chars: int):
+    """
+    One time step of the LSTM with gaussian attention, compiled with TorchScript (or torch.compile) so that the
+    pointwise operations of the lstm gates and of the attention window are fused into a few kernels
+    """
+    # Compute the new hidden state of the lstm cell, the strokes contribution to the gates is precomputed and the
+    # contributions of the previous window and hidden state are computed by a single matmul
+    gates = torch.addmm(strokes_gates_t, torch.cat([window_prev, hx], dim=-1), weight_recurrent.t())
+    hy, cy = lstm_gates(gates, cx)
+
+    # Compute the new gaussian attention window
+    alpha, beta, kappa = compute_window_parameters(hy, kappa_prev, window_weight, window_bias)
+    window, phi = compute_window(alpha, beta, kappa, sentences, sentences_mask, u_matrix, num_chars)
+
+    return hy, cy, alpha, beta, kappa, window, phi
+
+
+attention_step = torch.jit.script(_attention_step)
 
 
 class LSTMWithGaussianAttention(nn.Module):
@@ -10,7 +63,8 @@ class LSTMWithGaussianAttention(nn.Module):
     Cf equation (52) in the paper by A. Graves
     """
 
-    def __init__(self, input_dim, hidden_dim, num_gaussian_window, num_chars, device):
+    def __init__(self, input_dim, hidden_dim, num_gaussian_window, num_chars, device, checkpoint_segment_len=None,
+                 compile_step=False):
         super(LSTMWithGaussianAttention, self).__init__()
 
         self.input_dim = input_dim
@@ -18,98 +72,144 @@ class LSTMWithGaussianAttention(nn.Module):
         self.num_gaussian_window = num_gaussian_window
         self.num_chars = num_chars
         self.device = device
+        self.checkpoint_segment_len = checkpoint_segment_len  # None disables the activation checkpointing
 
+        # The time step is compiled with TorchScript, or with torch.compile if compile_step. Only the step is compiled:
+        # compiling the whole forward would unroll the loop over the strokes and recompile for every sequence length
+        self.attention_step = torch.compile(_attention_step, dynamic=True) if compile_step else attention_step
+
+        # Only holds the parameters of the lstm cell, the time step computes the cell with them
         self.lstm_cell = nn.LSTMCell(input_size=input_dim + self.num_chars,
                                      hidden_size=hidden_dim)
 
         self.window_layer = nn.Linear(self.hidden_dim, 3 * self.num_gaussian_window)
-        self.hidden, self.window_params, self.window = self.init_hidden_and_window()
+        self.register_buffer('u_matrix_cache', torch.empty(0), persistent=False)  # Character positions, (1, 1, L)
+        self.hidden, self.window_params, self.window = self.init_hidden_and_window(1, self.device, torch.float)
         self.re_init = True  # Re initialize the hidden and window params when forward is called
 
     def forward(self, strokes, sentences, sentences_mask):
         batch_size, strokes_seq_len, _ = strokes.size()
-
-        # The list containing the hidden states and the window states
-        hidden_seq = []
-        window_seq = []
-        phi_seq = []
+        char_seq_len = sentences.size(-1)
 
         # If training : initialization of the hidden state, of the window params and of the window
         if self.re_init:
-            self.hidden, self.window_params, self.window = self.init_hidden_and_window(batch_size)
-
-        for t in range(strokes_seq_len):
-
-            # Prepare the input for the lstm cell
-            x_t = strokes[:, t, :]
-            input_t = torch.cat([x_t, self.window], dim=-1)
-
-            # Compute the new hidden state of the lstm cell
-            self.hidden = self.lstm_cell(input_t, self.hidden)  # 2 * (bs, hidden_dim)
-
-            # Compute the new gaussian attention window
-            self.window_params = self.compute_window_parameters(self.hidden, self.window_params)
-            self.window, phi = self.compute_window(sentences, sentences_mask, self.window_params)   # (bs, num_chars)
-
-            hidden_seq.append(self.hidden[0])
-            window_seq.append(self.window)
-            phi_seq.append(phi)
-
-        hidden_seq_tensor = torch.stack(hidden_seq, dim=1)   # (bs, strokes_seq_len, hidden_dim)
-        window_seq_tensor = torch.stack(window_seq, dim=1)   # (bs, strokes_seq_len, num_chars)
-        phi_seq_tensor = torch.stack(phi_seq, dim=1)         # (bs, strokes_seq_len, chars_seq_len)
+            self.hidden, self.window_params, self.window = self.init_hidden_and_window(batch_size, strokes.device,
+                                                                                       strokes.dtype)
+
+        # The sentences mask and the character positions do not depend on the time step. The character positions are
+        # cached across the batches and only rebuilt for a longer sentence, another device or dtype. They are never
+        # built as inference tensors since the cache is shared by the training and validation forwards
+        sentences_mask = sentences_mask.float()
+        if (self.u_matrix_cache.numel() < char_seq_len or self.u_matrix_cache.device != strokes.device or
+                self.u_matrix_cache.dtype != strokes.dtype):
+            with torch.inference_mode(False):
+                self.u_matrix_cache = torch.arange(0, char_seq_len, dtype=strokes.dtype,
+                                                   device=strokes.device).reshape(1, 1, -1)
+        u_matrix = self.u_matrix_cache[..., :char_seq_len]
+
+        # The window fed to the lstm cell at time t depends on its hidden state at time t-1, so the recurrence can not
+        # be vectorized, but the strokes part of the lstm input does not: its contribution to the gates (biases
+        # included) is computed for all the time steps in a single matmul
+        weight_ih_strokes, weight_ih_window = self.lstm_cell.weight_ih.split([self.input_dim, self.num_chars], dim=1)
+        strokes_gates = F.linear(strokes, weight_ih_strokes, self.lstm_cell.bias_ih + self.lstm_cell.bias_hh)
+
+        # The weights applied at each time step to the concatenation of the previous window and hidden state
+        weight_recurrent = torch.cat([weight_ih_window, self.lstm_cell.weight_hh], dim=1)
+
+        # With activation checkpointing the time steps are run by segments whose activations are recomputed in
+        # backward instead of being stored
+        use_checkpoint = self.checkpoint_segment_len is not None and self.training and torch.is_grad_enabled()
+        segment_len = self.checkpoint_segment_len if use_checkpoint else strokes_seq_len
+
+        # The checkpointed segments run the eager step: the recomputation in backward must save the same tensors as
+        # the forward, which the profiling and fusion of the TorchScript executor and the graphs of torch.compile do
+        # not guarantee
+        step = _attention_step if use_checkpoint else self.attention_step
+
+        segments_outputs = []
+        for start in range(0, strokes_seq_len, segment_len):
+            segment_inputs = (strokes_gates[:, start:start + segment_len], self.hidden[0], self.hidden[1],
+                              self.window_params[-1], self.window, sentences, sentences_mask, u_matrix,
+                              weight_recurrent, step)
+            if use_checkpoint:
+                outputs = checkpoint(self.forward_segment, *segment_inputs, use_reentrant=False)
+            else:
+                outputs = self.forward_segment(*segment_inputs)
+
+            hx, cx, alpha, beta, kappa, self.window = outputs[:6]
+            self.hidden = (hx, cx)  # 2 * (bs, hidden_dim)
+            self.window_params = (alpha, beta, kappa)
+            segments_outputs.append(outputs[6:])
+
+        if len(segments_outputs) == 1:
+            hidden_seq_tensor, window_seq_tensor, phi_seq_tensor = segments_outputs[0]
+        else:
+            hidden_seq_tensor, window_seq_tensor, phi_seq_tensor = [torch.cat(seq, dim=1)
+                                                                    for seq in zip(*segments_outputs)]
 
         return hidden_seq_tensor, window_seq_tensor, phi_seq_tensor
 
-    def init_hidden_and_window(self, batch_size=1):
+    def forward_segment(self, strokes_gates, hx, cx, kappa, window, sentences, sentences_mask, u_matrix,
+                        weight_recurrent, step):
+        batch_size, segment_len, _ = strokes_gates.size()
+        char_seq_len = sentences.size(-1)
+
+        # The hidden states, the window states and phi. Without autograd they are written in place in preallocated
+        # tensors, with autograd every slice assignment would copy the whole tensor in backward so they are stacked
+        preallocate = not torch.is_grad_enabled()
+        if preallocate:
+            hidden_seq_tensor = strokes_gates.new_empty(batch_size, segment_len, self.hidden_dim)
+            window_seq_tensor = strokes_gates.new_empty(batch_size, segment_len, self.num_chars)
+            phi_seq_tensor = strokes_gates.new_empty(batch_size, segment_len, char_seq_len)
+        else:
+            hidden_seq = []
+            window_seq = []
+            phi_seq = []
+
+        for t in range(segment_len):
+
+            hx, cx, alpha, beta, kappa, window, phi = step(strokes_gates[:, t, :],
+                                                           hx,
+                                                           cx,
+                                                           kappa,
+                                                           window,
+                                                           sentences,
+                                                           sentences_mask,
+                                                           u_matrix,
+                                                           weight_recurrent,
+                                                           self.window_layer.weight,
+                                                           self.window_layer.bias,
+                                                           self.num_chars)
+
+            if preallocate:
+                hidden_seq_tensor[:, t] = hx
+                window_seq_tensor[:, t] = window
+                phi_seq_tensor[:, t] = phi
+            else:
+                hidden_seq.append(hx)
+                window_seq.append(window)
+                phi_seq.append(phi)
+
+        if not preallocate:
+            hidden_seq_tensor = torch.stack(hidden_seq, dim=1)   # (bs, segment_len, hidden_dim)
+            window_seq_tensor = torch.stack(window_seq, dim=1)   # (bs, segment_len, num_chars)
+            phi_seq_tensor = torch.stack(phi_seq, dim=1)         # (bs, segment_len, chars_seq_len)
+
+        return hx, cx, alpha, beta, kappa, window, hidden_seq_tensor, window_seq_tensor, phi_seq_tensor
+
+    def init_hidden_and_window(self, batch_size, device, dtype):
 
         # init hidden
-        hidden_t = (torch.zeros(batch_size, self.hidden_dim, device=self.device),
-                    torch.zeros(batch_size, self.hidden_dim, device=self.device))
+        hidden_t = (torch.zeros(batch_size, self.hidden_dim, device=device, dtype=dtype),
+                    torch.zeros(batch_size, self.hidden_dim, device=device, dtype=dtype))
 
         # init window params
-        alpha_t = torch.zeros(batch_size, self.num_gaussian_window, device=self.device)
-        beta_t  = torch.zeros(batch_size, self.num_gaussian_window, device=self.device)
-        kappa_t = torch.zeros(batch_size, self.num_gaussian_window, device=self.device)
+        alpha_t = torch.zeros(batch_size, self.num_gaussian_window, device=device, dtype=dtype)
+        beta_t  = torch.zeros(batch_size, self.num_gaussian_window, device=device, dtype=dtype)
+        kappa_t = torch.zeros(batch_size, self.num_gaussian_window, device=device, dtype=dtype)
         window_params_t = (alpha_t, beta_t, kappa_t)
 
         # init window
-        window_t = torch.zeros(batch_size, self.num_chars, device=self.device)
+        window_t = torch.zeros(batch_size, self.num_chars, device=device, dtype=dtype)
 
         return hidden_t, window_params_t, window_t
-
-    def compute_window_parameters(self, hidden_t, window_params_t):
-        window_params_hat = self.window_layer(hidden_t[0])
-        alpha_hat, beta_hat, kappa_hat = window_params_hat.split(self.num_gaussian_window, dim=1)
-        previous_kappa = window_params_t[-1]
-
-        # Normalization of the params according to equations (49), (50), (51)
-        alpha = torch.exp(alpha_hat)  # (bs, K)
-        beta = torch.exp(beta_hat)
-        kappa = previous_kappa + torch.exp(kappa_hat)
-
-        return alpha, beta, kappa
-
-    def compute_window(self, sentences, sentences_mask, window_params):
-        alpha, beta, kappa = window_params
-        char_seq_len = sentences.size(-1)
-
-        # Prepare tensors for broadcasting, target shape = (bs, K, chars_seq_len)
-        alpha = alpha.unsqueeze(-1)
-        beta = beta.unsqueeze(-1)
-        kappa = kappa.unsqueeze(-1)
-        u_matrix = torch.arange(0, char_seq_len, dtype=torch.float, device=self.device).reshape(1, 1, -1)
-        sentences_mask = sentences_mask.unsqueeze(-1)
-
-        # Compute phi (bs, chars_seq_len)
-        phi = alpha * torch.exp(-beta * (kappa - u_matrix) ** 2)
-        phi = phi.sum(1).unsqueeze(-1)
-
-        # Compute the one hot encoding of the character sequence (bs, chars_seq_len, num_chars)
-        char_seq_encoding = F.one_hot(sentences, num_classes=self.num_chars).float()
-
-        window = phi * char_seq_encoding  # (bs, char_seq_len, num_chars)
-        window = window * sentences_mask.float()  # Apply the sentences mask
-        window = window.sum(1)  # (bs, num_chars)
-
-        return window, phi.squeeze(2)
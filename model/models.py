@@ -150,7 +150,7 @@ class ConditionalHandwriting(BaseModel):
     """
 
     def __init__(self, input_dim, hidden_dim, num_layers, num_gaussian_out, dropout, num_chars, num_gaussian_window,
-                 char2idx, device):
+                 char2idx, device, checkpoint_segment_len=None, compile_attention=False):
         super(ConditionalHandwriting, self).__init__()
 
         # Params
@@ -172,7 +172,9 @@ class ConditionalHandwriting(BaseModel):
                                                                        hidden_dim=hidden_dim,
                                                                        num_gaussian_window=num_gaussian_window,
                                                                        num_chars=num_chars,
-                                                                       device=self.device)
+                                                                       device=self.device,
+                                                                       checkpoint_segment_len=checkpoint_segment_len,
+                                                                       compile_step=compile_attention)
 
         self.rnn_2 = nn.LSTM(input_size=input_dim + hidden_dim + num_chars,
                              hidden_size=hidden_dim,
@@ -237,7 +239,7 @@ class ConditionalHandwriting(BaseModel):
         sentence += ' '
 
         # Transforming the sentence into a tensor
-        sentence = torch.tensor(data=[self.char2idx[char] for char in sentence], dtype=torch.long)
+        sentence = torch.tensor(data=[[self.char2idx[char] for char in sentence]], dtype=torch.long)  # (bs, seq_len)
         sentence_mask = torch.ones(sentence.shape)
 
         # Prepare input sequence
@@ -272,7 +274,7 @@ class ConditionalHandwriting(BaseModel):
                 pi, mu1, mu2, sigma1, sigma2, rho, eos = gaussian_params
 
                 # Exit condition
-                if int(torch.argmax(phi)) + 1 == sentence.size(0):
+                if int(torch.argmax(phi)) + 1 == sentence.size(1):
                     break
 
                 # Sample the next stroke
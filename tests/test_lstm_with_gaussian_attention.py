@@ -0,0 +1,102 @@
+import torch
+import torch.nn.functional as F
+from model.custom_layers.lstm_with_gaussian_attention import LSTMWithGaussianAttention
+
+INPUT_DIM, HIDDEN_DIM, NUM_GAUSSIAN_WINDOW, NUM_CHARS = 3, 8, 3, 6
+
+
+def reference_forward(layer, strokes, sentences, sentences_mask):
+    """
+    Original implementation of the layer: nn.LSTMCell and a one hot window computed step by step
+    """
+    batch_size, strokes_seq_len, _ = strokes.size()
+    hidden = (torch.zeros(batch_size, HIDDEN_DIM), torch.zeros(batch_size, HIDDEN_DIM))
+    kappa = torch.zeros(batch_size, NUM_GAUSSIAN_WINDOW)
+    window = torch.zeros(batch_size, NUM_CHARS)
+    u_matrix = torch.arange(0, sentences.size(-1), dtype=torch.float).reshape(1, 1, -1)
+    char_seq_encoding = F.one_hot(sentences, num_classes=NUM_CHARS).float()
+
+    hidden_seq, window_seq, phi_seq = [], [], []
+    for t in range(strokes_seq_len):
+        hidden = layer.lstm_cell(torch.cat([strokes[:, t, :], window], dim=-1), hidden)
+        alpha_hat, beta_hat, kappa_hat = layer.window_layer(hidden[0]).split(NUM_GAUSSIAN_WINDOW, dim=1)
+        alpha = torch.exp(alpha_hat).unsqueeze(-1)
+        beta = torch.exp(beta_hat).unsqueeze(-1)
+        kappa = kappa + torch.exp(kappa_hat)
+        phi = (alpha * torch.exp(-beta * (kappa.unsqueeze(-1) - u_matrix) ** 2)).sum(1).unsqueeze(-1)
+        window = (phi * char_seq_encoding * sentences_mask.unsqueeze(-1).float()).sum(1)
+        hidden_seq.append(hidden[0])
+        window_seq.append(window)
+        phi_seq.append(phi.squeeze(2))
+
+    return torch.stack(hidden_seq, dim=1), torch.stack(window_seq, dim=1), torch.stack(phi_seq, dim=1)
+
+
+def layer_forward(layer, strokes, sentences, sentences_mask):
+    return layer(strokes, sentences, sentences_mask)
+
+
+def make_inputs(batch_size=3, strokes_seq_len=7):
+    # Padded sentences of different lengths, the padding index 0 is masked
+    lengths = torch.tensor([5, 2, 4])[:batch_size]
+    sentences = torch.randint(1, NUM_CHARS, (batch_size, int(lengths.max())))
+    sentences_mask = torch.arange(sentences.size(1))[None, :] < lengths[:, None]
+    sentences = sentences * sentences_mask.long()
+    strokes = torch.randn(batch_size, strokes_seq_len, INPUT_DIM)
+    return strokes, sentences, sentences_mask
+
+
+def outputs_and_grads(forward, layer, inputs, output_weights):
+    outputs = forward(layer, *inputs)
+    loss = sum((output * weight).sum() for output, weight in zip(outputs, output_weights))
+    grads = torch.autograd.grad(loss, list(layer.parameters()))
+    return [output.detach() for output in outputs], grads
+
+
+def test_forward_and_grads_match_reference():
+    torch.manual_seed(0)
+    layer = LSTMWithGaussianAttention(INPUT_DIM, HIDDEN_DIM, NUM_GAUSSIAN_WINDOW, NUM_CHARS, torch.device('cpu'))
+    inputs = make_inputs()
+
+    # Several passes, the first calls of the scripted step are profiling runs
+    output_weights = [torch.randn_like(output.detach()) for output in reference_forward(layer, *inputs)]
+    for _ in range(3):
+        expected, expected_grads = outputs_and_grads(reference_forward, layer, inputs, output_weights)
+        actual, actual_grads = outputs_and_grads(layer_forward, layer, inputs, output_weights)
+
+        for actual_output, expected_output in zip(actual, expected):
+            assert torch.allclose(actual_output, expected_output, atol=1e-5)
+        for actual_grad, expected_grad in zip(actual_grads, expected_grads):
+            assert torch.allclose(actual_grad, expected_grad, atol=1e-5)
+
+
+def test_forward_without_grad_matches_reference():
+    torch.manual_seed(0)
+    layer = LSTMWithGaussianAttention(INPUT_DIM, HIDDEN_DIM, NUM_GAUSSIAN_WINDOW, NUM_CHARS, torch.device('cpu'))
+    inputs = make_inputs()
+
+    with torch.no_grad():
+        expected = reference_forward(layer, *inputs)
+        actual = layer(*inputs)
+
+    for actual_output, expected_output in zip(actual, expected):
+        assert torch.allclose(actual_output, expected_output, atol=1e-5)
+
+
+def test_checkpointed_forward_and_grads_match_uncheckpointed():
+    torch.manual_seed(0)
+    layer = LSTMWithGaussianAttention(INPUT_DIM, HIDDEN_DIM, NUM_GAUSSIAN_WINDOW, NUM_CHARS, torch.device('cpu'))
+    inputs = make_inputs()
+
+    # Segments of 2 time steps, the last segment is shorter, over several passes of the scripted step
+    output_weights = [torch.randn_like(output.detach()) for output in layer(*inputs)]
+    for _ in range(3):
+        layer.checkpoint_segment_len = None
+        expected, expected_grads = outputs_and_grads(layer_forward, layer, inputs, output_weights)
+        layer.checkpoint_segment_len = 2
+        actual, actual_grads = outputs_and_grads(layer_forward, layer, inputs, output_weights)
+
+        for actual_output, expected_output in zip(actual, expected):
+            assert torch.allclose(actual_output, expected_output, atol=1e-5)
+        for actual_grad, expected_grad in zip(actual_grads, expected_grads):
+            assert torch.allclose(actual_grad, expected_grad, atol=1e-5)
@@ -13,7 +13,6 @@ from trainer import Trainer
 SEED = 123
 torch.manual_seed(SEED)
 torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
 np.random.seed(SEED)
 
 
@@ -1,8 +1,18 @@
 import numpy as np
 import torch
+from enum import Enum
 from torch.nn.utils import clip_grad_norm_
 from base import BaseTrainer
-from utils import inf_loop, MetricTracker
+from utils import inf_loop, MetricTracker, CudaPrefetcher
+
+
+class ModelKind(Enum):
+    """
+    Kinds of models handled by the trainer, the value is the prefix of the model class name
+    """
+    UNCONDITIONAL = 'Unconditional'
+    CONDITIONAL = 'Conditional'
+    SEQ2SEQ = 'Seq2Seq'
 
 
 class Trainer(BaseTrainer):
@@ -12,6 +22,14 @@ class Trainer(BaseTrainer):
     def __init__(self, model, criterion, metric_ftns, optimizer, config, device,
                  data_loader, valid_data_loader=None, lr_scheduler=None, len_epoch=None):
         super().__init__(model, criterion, metric_ftns, optimizer, config, device)
+
+        # Let cuDNN pick the fastest algorithms for the input shapes and use TF32 tensor cores for float32 matmuls
+        if self.device.type == 'cuda':
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
         self.config = config
         self.data_loader = data_loader
         if len_epoch is None:
@@ -25,10 +43,42 @@ class Trainer(BaseTrainer):
         self.do_validation = self.valid_data_loader is not None
         self.lr_scheduler = lr_scheduler
         self.log_step = int(np.sqrt(data_loader.batch_size))
+        self.hist_every = config['trainer'].get('hist_every', 10)
+
+        # Optional mixed precision training on GPU: bfloat16 on GPUs with native support (compute capability >= 8),
+        # float16 otherwise, the loss scaling is only needed for float16
+        self.use_amp = self.device.type == 'cuda' and config['trainer'].get('amp', False)
+        self.amp_dtype = None  # Default autocast dtype, only used with autocast disabled
+        if self.use_amp:
+            native_bf16 = torch.cuda.get_device_capability(self.device)[0] >= 8
+            self.amp_dtype = torch.bfloat16 if native_bf16 else torch.float16
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.amp_dtype == torch.float16)
+
+        # The kind of model and the parameters to clip are set once, instead of checking str(model) per batch. The
+        # parameters are clipped together by their global norm, with a single reduction
+        model_name = type(self.model).__name__
+        model_kinds = [kind for kind in ModelKind if model_name.startswith(kind.value)]
+        if not model_kinds:
+            raise NotImplementedError("Not a valid model name")
+        self._model_kind = model_kinds[0]
+        if self._model_kind == ModelKind.UNCONDITIONAL:
+            self._clip_params = (list(self.model.rnn_1.parameters()) +
+                                 list(self.model.rnn_2.parameters()) +
+                                 list(self.model.rnn_3.parameters()))
+        elif self._model_kind == ModelKind.CONDITIONAL:
+            self._clip_params = (list(self.model.rnn_1_with_gaussian_attention.lstm_cell.parameters()) +
+                                 list(self.model.rnn_2.parameters()) +
+                                 list(self.model.rnn_3.parameters()))
+        else:
+            self._clip_params = list(self.model.parameters())
 
         self.train_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns], writer=self.writer)
         self.valid_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns], writer=self.writer)
 
+        # The training loss is summed on the device, and only synchronized when logged and at the end of the epoch
+        self._loss_accum = torch.zeros((), device=self.device)
+        self._loss_count = 0
+
     def _train_epoch(self, epoch):
         """
         Training logic for an epoch
@@ -38,49 +88,39 @@ class Trainer(BaseTrainer):
         """
         self.model.train()
         self.train_metrics.reset()
-        for batch_idx, (sentences, sentences_mask, strokes, strokes_mask) in enumerate(self.data_loader):
+        self._loss_accum.zero_()
+        self._loss_count = 0
+        # On GPU the next batch is copied to the device on a side stream while the current one is processed. The loop
+        # stops after the batch of index len_epoch, so no more than len_epoch + 1 batches are loaded
+        if self.device.type == 'cuda':
+            batches = CudaPrefetcher(self.data_loader, self.device, max_batches=self.len_epoch + 1)
+        else:
+            batches = self.data_loader
+        for batch_idx, (sentences, sentences_mask, strokes, strokes_mask) in enumerate(batches):
 
-            # Moving input data to device
-            sentences, sentences_mask = sentences.to(self.device), sentences_mask.to(self.device)
-            strokes, strokes_mask = strokes.to(self.device), strokes_mask.to(self.device)
+            # Moving input data to device, the batches prefetched on the device are returned as is
+            sentences = sentences.to(self.device, non_blocking=True)
+            sentences_mask = sentences_mask.to(self.device, non_blocking=True)
+            strokes = strokes.to(self.device, non_blocking=True)
+            strokes_mask = strokes_mask.to(self.device, non_blocking=True)
 
             # Compute the loss and perform an optimization step
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
-            if str(self.model).startswith('Unconditional'):
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
                 output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                gaussian_params = self.model.compute_gaussian_parameters(output_network)
-                loss = self.criterion(gaussian_params, strokes, strokes_mask)
-                loss.backward()
-                # Gradient clipping
-                clip_grad_norm_(self.model.rnn_1.parameters(), 10)
-                clip_grad_norm_(self.model.rnn_2.parameters(), 10)
-                clip_grad_norm_(self.model.rnn_3.parameters(), 10)
-
-            elif str(self.model).startswith('Conditional'):
-                output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                gaussian_params = self.model.compute_gaussian_parameters(output_network)
-                loss = self.criterion(gaussian_params, strokes, strokes_mask)
-                loss.backward()
-                # Gradient clipping
-                clip_grad_norm_(self.model.rnn_1_with_gaussian_attention.lstm_cell.parameters(), 10)
-                clip_grad_norm_(self.model.rnn_2.parameters(), 10)
-                clip_grad_norm_(self.model.rnn_3.parameters(), 10)
-
-            elif str(self.model).startswith('Seq2Seq'):
-                output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                loss = self.criterion(output_network, sentences, sentences_mask)
-                loss.backward()
-                # Gradient clipping
-                clip_grad_norm_(self.model.parameters(), 10)
-
-            else:
-                NotImplementedError("Not a valid model name")
+                loss = self._compute_loss(output_network, sentences, sentences_mask, strokes, strokes_mask)
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.optimizer)
+            # Gradient clipping
+            clip_grad_norm_(self._clip_params, 10)
 
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             self.writer.set_step((epoch - 1) * self.len_epoch + batch_idx)
-            self.train_metrics.update('loss', loss.item())
+            self._loss_accum += loss.detach()
+            self._loss_count += 1
 
             if batch_idx % self.log_step == 0:
                 self.logger.debug('Train Epoch: {} {} Loss: {:.6f}'.format(
@@ -90,6 +130,7 @@ class Trainer(BaseTrainer):
 
             if batch_idx == self.len_epoch:
                 break
+        self.train_metrics.update('loss', (self._loss_accum / self._loss_count).item(), n=self._loss_count)
         log = self.train_metrics.result()
 
         if self.do_validation:
@@ -109,38 +150,46 @@ class Trainer(BaseTrainer):
         """
         self.model.eval()
         self.valid_metrics.reset()
-        with torch.no_grad():
+        with torch.inference_mode():
+            # The validation loss is summed on the device and synchronized once at the end of the epoch
+            loss_sum = torch.zeros((), device=self.device)
             for batch_idx, (sentences, sentences_mask, strokes, strokes_mask) in enumerate(self.valid_data_loader):
 
                 # Moving input data to device
-                sentences, sentences_mask = sentences.to(self.device), sentences_mask.to(self.device)
-                strokes, strokes_mask = strokes.to(self.device), strokes_mask.to(self.device)
+                sentences = sentences.to(self.device, non_blocking=True)
+                sentences_mask = sentences_mask.to(self.device, non_blocking=True)
+                strokes = strokes.to(self.device, non_blocking=True)
+                strokes_mask = strokes_mask.to(self.device, non_blocking=True)
 
                 # Compute the loss
-                if str(self.model).startswith('Unconditional'):
-                    output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                    gaussian_params = self.model.compute_gaussian_parameters(output_network)
-                    loss = self.criterion(gaussian_params, strokes, strokes_mask)
+                output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
+                loss = self._compute_loss(output_network, sentences, sentences_mask, strokes, strokes_mask)
 
-                elif str(self.model).startswith('Conditional'):
-                    output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                    gaussian_params = self.model.compute_gaussian_parameters(output_network)
-                    loss = self.criterion(gaussian_params, strokes, strokes_mask)
+                loss_sum += loss
 
-                elif str(self.model).startswith('Seq2Seq'):
-                    output_network = self.model(sentences, sentences_mask, strokes, strokes_mask)
-                    loss = self.criterion(output_network, sentences, sentences_mask)
+            num_batches = len(self.valid_data_loader)
+            self.writer.set_step(epoch * num_batches - 1, 'valid')
+            self.valid_metrics.update('loss', (loss_sum / num_batches).item(), n=num_batches)
 
-                else:
-                    NotImplementedError("Not a valid model name")
+        # add histogram of model parameters to the tensorboard, every hist_every epochs and on a subsample of about
+        # 65536 values per parameter with a fixed number of bins to bound the cost of the sort on the CPU
+        if epoch % self.hist_every == 0:
+            for name, p in self.model.named_parameters():
+                p = p.detach().flatten()
+                self.writer.add_histogram(name, p[::max(1, p.numel() // 65536)].float().cpu(), bins=64)
+        return self.valid_metrics.result()
 
-                self.writer.set_step((epoch - 1) * len(self.valid_data_loader) + batch_idx, 'valid')
-                self.valid_metrics.update('loss', loss.item())
+    def _compute_loss(self, output_network, sentences, sentences_mask, strokes, strokes_mask):
+        """
+        Compute the loss of the model output according to the kind of model
 
-        # add histogram of model parameters to the tensorboard
-        for name, p in self.model.named_parameters():
-            self.writer.add_histogram(name, p, bins='auto')
-        return self.valid_metrics.result()
+        :return: The loss of the batch
+        """
+        if self._model_kind == ModelKind.SEQ2SEQ:
+            return self.criterion(output_network, sentences, sentences_mask)
+
+        gaussian_params = self.model.compute_gaussian_parameters(output_network)
+        return self.criterion(gaussian_params, strokes, strokes_mask)
 
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
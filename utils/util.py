@@ -5,7 +5,7 @@ from itertools import repeat
 from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
-import torch.tensor
+import torch
 from torch.nn.utils.rnn import pad_sequence
 
 
@@ -89,6 +89,48 @@ def inf_loop(data_loader):
         yield from loader
 
 
+class CudaPrefetcher:
+    """
+    Iterates over a data loader and copies the next batch to the device on a side CUDA stream while the current batch
+    is processed. The batches should be pinned by the data loader so that the copies are asynchronous.
+    At most max_batches batches are loaded, so that no batch is fetched ahead of the last one consumed.
+    """
+    def __init__(self, data_loader, device, max_batches=None):
+        self.data_loader = data_loader
+        self.device = device
+        self.max_batches = max_batches
+
+    def __iter__(self):
+        copy_stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.data_loader)
+        num_batches = 1
+        next_batch = self._preload(batches, copy_stream)
+        while next_batch is not None:
+            batch, copy_event = next_batch
+            # Wait for the copy of the batch, and prevent its memory from being reused before the compute is done
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(copy_event)
+            for tensor in batch:
+                tensor.record_stream(compute_stream)
+            if self.max_batches is None or num_batches < self.max_batches:
+                num_batches += 1
+                next_batch = self._preload(batches, copy_stream)
+            else:
+                next_batch = None
+            yield batch
+
+    def _preload(self, batches, copy_stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(copy_stream):
+            batch = tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+            copy_event = torch.cuda.Event()
+            copy_event.record(copy_stream)
+        return batch, copy_event
+
+
 class MetricTracker:
     def __init__(self, *keys, writer=None):
         self.writer = writer